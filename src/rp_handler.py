@@ -1,23 +1,107 @@
 import runpod
-from runpod.serverless.utils import rp_upload
-import json
-import urllib.request
-import urllib.parse
+import orjson
+import asyncio
 import time
+import random
+import re
 import os
-import requests
-import base64
-from io import BytesIO
+import uuid
+import aiohttp
+import binascii
+import queue
+import hashlib
+from collections import OrderedDict
 
 # ==========================================
 # CONFIGURATION
 # ==========================================
-COMFY_API_AVAILABLE_INTERVAL_MS = 50
+COMFY_API_AVAILABLE_INTERVAL_MS = 10
 COMFY_API_AVAILABLE_MAX_RETRIES = 500
+# Overall time to wait for ComfyUI, the budget of the former fixed 500 x 50 ms retries
+COMFY_API_AVAILABLE_TIMEOUT_MS = 25000
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
 COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
+COMFY_POLLING_BACKOFF_START_MS = 50
+COMFY_POLLING_BACKOFF_MAX_MS = 2000
 COMFY_HOST = "127.0.0.1:8188"
+COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+# Output path with a trailing separator, for files without a subfolder
+COMFY_OUTPUT_BASE = os.path.join(COMFY_OUTPUT_PATH, "")
+BUCKET_URL = os.environ.get("BUCKET_ENDPOINT_URL")
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+DEBUG_OUTPUTS = os.environ.get("DEBUG_OUTPUTS", "false").lower() == "true"
+# One ComfyUI client per worker process, shared by all jobs
+CLIENT_ID = uuid.uuid4().hex
+DOWNLOAD_CHUNK_BYTES = int(os.environ.get("DOWNLOAD_CHUNK_BYTES", 4 * 1024 * 1024))
+UPLOAD_MAX_WORKERS = 6
+S3_UPLOAD_MAX_WORKERS = 8
+BASE64_DECODE_CHUNK_CHARS = 4 * 1024 * 1024  # must be a multiple of 4
+BASE64_ENCODE_CHUNK_BYTES = 3 * 1024 * 1024  # must be a multiple of 3
+RESULT_CACHE_MAX_ITEMS = 128
+RESULT_CACHE_TTL_S = int(os.environ.get("RESULT_CACHE_TTL_S", 0))
+
+
+# Shared aiohttp sessions, created on first use inside the worker's event loop
+# (see get_session). The handler is reused between jobs, so keeping the
+# connections alive avoids a new TCP handshake per request. ComfyUI traffic
+# and input downloads from other hosts use separate connection pools.
+_session = None
+_download_session = None
+_session_loop = None
+
+# Websocket for ComfyUI execution events, opened on first use (see get_websocket)
+_websocket = None
+
+
+def _drop_stale_sessions():
+    """
+    Forget the sessions and websocket of a previous event loop.
+
+    They are closed only while that loop is still running. The close coroutine
+    can't run on a loop that has finished, so their connections are leaked
+    instead.
+    """
+    global _session, _download_session, _websocket
+    if _session_loop is not None and _session_loop.is_running():
+        for conn in (_websocket, _session, _download_session):
+            if conn is not None and not conn.closed:
+                asyncio.run_coroutine_threadsafe(conn.close(), _session_loop)
+    _session = _download_session = _websocket = None
+
+
+def _ensure_sessions():
+    """(Re)create the sessions for the running event loop."""
+    global _session, _download_session, _session_loop
+    loop = asyncio.get_running_loop()
+    if (
+        _session_loop is not loop
+        or _session is None
+        or _session.closed
+        or _download_session.closed
+    ):
+        _drop_stale_sessions()
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30)
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16),
+            timeout=timeout,
+        )
+        _download_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16),
+            timeout=timeout,
+        )
+        _session_loop = loop
+
+
+def get_session():
+    """Return the worker's aiohttp session for ComfyUI calls."""
+    _ensure_sessions()
+    return _session
+
+
+def get_download_session():
+    """Return the worker's aiohttp session for downloading URL inputs."""
+    _ensure_sessions()
+    return _download_session
 
 
 # ==========================================
@@ -30,8 +114,8 @@ def validate_input(job_input):
 
     if isinstance(job_input, str):
         try:
-            job_input = json.loads(job_input)
-        except json.JSONDecodeError:
+            job_input = orjson.loads(job_input)
+        except orjson.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
     workflow = job_input.get("workflow")
@@ -54,17 +138,31 @@ def validate_input(job_input):
 # ==========================================
 # SERVER CONNECTION
 # ==========================================
-def check_server(url, retries=500, delay=50):
-    """Check if ComfyUI API is reachable."""
+def backoff_delay(attempt, delay, max_delay):
+    """Exponential backoff in seconds for the given attempt, with a little jitter."""
+    return min(delay * 2 ** min(attempt, 8), max_delay) / 1000 + random.uniform(0, 0.01)
+
+
+async def check_server(url, retries=500, delay=10, max_delay=1000, timeout=COMFY_API_AVAILABLE_TIMEOUT_MS):
+    """
+    Check if ComfyUI API is reachable, backing off exponentially between attempts.
+    Gives up after `retries` attempts or `timeout` milliseconds, whichever comes first.
+    """
+    session = get_session()
+    deadline = time.monotonic() + timeout / 1000
     for i in range(retries):
+        if i and time.monotonic() >= deadline:
+            break
         try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                print("runpod-worker-comfy - API is reachable")
-                return True
-        except requests.RequestException:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=1)) as response:
+                if response.status == 200:
+                    print("runpod-worker-comfy - API is reachable")
+                    return True
+        except (aiohttp.ClientError, asyncio.TimeoutError):
             pass
-        time.sleep(delay / 1000)
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            await asyncio.sleep(min(backoff_delay(i, delay, max_delay), remaining))
 
     print(f"runpod-worker-comfy - Failed to connect to {url}")
     return False
@@ -73,9 +171,170 @@ def check_server(url, retries=500, delay=50):
 # ==========================================
 # IMAGE / VIDEO UPLOAD (Base64 or URL)
 # ==========================================
-def upload_images(images):
-    """Upload files (Base64 or via URL) to ComfyUI /upload/image endpoint."""
-    if not images:
+def _multipart_envelope(name, boundary):
+    """Return the multipart/form-data bytes that go before and after the file for /upload/image."""
+    filename = name.replace('"', "%22")
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="overwrite"\r\n\r\n'
+        "true\r\n"
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+    return head, tail
+
+
+async def _multipart_body(head, chunks, tail):
+    """Yield the multipart body around an async iterator of file chunks, without buffering the file."""
+    yield head
+    async for chunk in chunks:
+        yield chunk
+    yield tail
+
+
+async def _single_chunk(data):
+    """Wrap an in-memory blob as an async chunk iterator."""
+    yield data
+
+
+async def _post_upload(name, chunks, size=None):
+    """
+    Stream the given async byte chunks to ComfyUI as the upload for `name`.
+    When the file `size` is known the body is sent with a Content-Length
+    instead of chunked transfer encoding. Returns (status, text).
+    """
+    boundary = uuid.uuid4().hex
+    head, tail = _multipart_envelope(name, boundary)
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    if size is not None:
+        headers["Content-Length"] = str(len(head) + size + len(tail))
+
+    async with get_session().post(
+        f"http://{COMFY_HOST}/upload/image",
+        data=_multipart_body(head, chunks, tail),
+        headers=headers,
+    ) as response:
+        return response.status, await response.text()
+
+
+# Decode buffers are kept across jobs so large base64 inputs on a warm worker
+# don't allocate a fresh multi-MB bytes object every time.
+_BUF_POOL = queue.LifoQueue(maxsize=UPLOAD_MAX_WORKERS)
+
+
+def get_buf(size):
+    """Take a bytearray of at least `size` bytes from the pool, or allocate one."""
+    try:
+        buf = _BUF_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray(size)
+    return buf if len(buf) >= size else bytearray(size)
+
+
+def put_buf(buf):
+    """Return a bytearray to the pool; dropped when the pool is full."""
+    try:
+        _BUF_POOL.put_nowait(buf)
+    except queue.Full:
+        pass
+
+
+# Characters a2b_base64 discards; removed up front so the chunks stay 4-character aligned
+_B64_NON_ALPHABET = re.compile(r"[^A-Za-z0-9+/=]")
+
+
+def b64decode_into(data, buf):
+    """Decode base64 `data` into `buf` chunk by chunk. Returns the number of bytes written."""
+    view = memoryview(buf)
+    offset = 0
+    for start in range(0, len(data), BASE64_DECODE_CHUNK_CHARS):
+        decoded = binascii.a2b_base64(data[start:start + BASE64_DECODE_CHUNK_CHARS])
+        view[offset:offset + len(decoded)] = decoded
+        offset += len(decoded)
+    return offset
+
+
+def _prepare_one(image):
+    """Decode a base64 input into a pooled buffer ahead of its upload; URL inputs are left as is."""
+    name = image.get("name")
+
+    if "url" in image:
+        return {"name": name, "url": image["url"]}
+    if "image" not in image:
+        return {"name": name, "error": f"No valid 'url' or 'image' found for {name}"}
+
+    buf = None
+    try:
+        data = image["image"]
+        if _B64_NON_ALPHABET.search(data):
+            # Chunked decoding needs 4-character aligned input
+            data = _B64_NON_ALPHABET.sub("", data)
+
+        buf = get_buf(len(data) * 3 // 4)
+        return {"name": name, "buf": buf, "length": b64decode_into(data, buf)}
+    except Exception as e:
+        if buf is not None:
+            put_buf(buf)
+        return {"name": name, "error": f"Error processing {name}: {str(e)}"}
+
+
+def _prefetch_blobs(images):
+    """
+    Prepare all inputs that don't need ComfyUI yet. URL inputs are not downloaded
+    here, they are streamed straight into the upload once ComfyUI is reachable.
+    """
+    return [_prepare_one(image) for image in images or ()]
+
+
+async def _process_one(item):
+    """Upload a single prepared input file to ComfyUI. Returns (ok, message)."""
+    name = item["name"]
+    if "error" in item:
+        return False, item["error"]
+
+    try:
+        # --- Case 1: URL-based upload ---
+        if "url" in item:
+            url = item["url"]
+            print(f"Downloading input from URL: {url}")
+            async with get_download_session().get(url) as r:
+                if r.status != 200:
+                    return False, f"Failed to download {name}: HTTP {r.status}"
+
+                # Pipe the download straight into the upload request, so the
+                # file never touches disk nor is held in memory as a whole.
+                chunks = r.content.iter_chunked(DOWNLOAD_CHUNK_BYTES)
+
+                # The size is only known up front if the download isn't compressed
+                size = None
+                encoding = r.headers.get("Content-Encoding", "identity")
+                if "Content-Length" in r.headers and encoding == "identity":
+                    size = int(r.headers["Content-Length"])
+
+                status, text = await _post_upload(name, chunks, size)
+
+        # --- Case 2: Base64-based upload (already decoded) ---
+        else:
+            blob = memoryview(item["buf"])[:item["length"]]
+            status, text = await _post_upload(name, _single_chunk(blob), item["length"])
+
+        if status != 200:
+            return False, f"Error uploading {name}: {text}"
+        return True, f"✅ Uploaded {name}"
+
+    except Exception as e:
+        return False, f"Error processing {name}: {str(e)}"
+
+    finally:
+        if "buf" in item:
+            put_buf(item["buf"])
+
+
+async def _post_prepared(prepared):
+    """Upload prepared inputs to the ComfyUI /upload/image endpoint."""
+    if not prepared:
         return {"status": "success", "message": "No input files to upload", "details": []}
 
     responses = []
@@ -83,48 +342,18 @@ def upload_images(images):
 
     print("runpod-worker-comfy - uploading input file(s)...")
 
-    for image in images:
-        name = image.get("name")
-        blob = None
+    # Download and upload all files concurrently
+    limit = asyncio.Semaphore(UPLOAD_MAX_WORKERS)
 
-        try:
-            # --- Case 1: URL-based upload ---
-            if "url" in image:
-                url = image["url"]
-                print(f"Downloading input from URL: {url}")
-                with requests.get(url, stream=True) as r:
-                    if r.status_code == 200:
-                        # Stream download to avoid memory overflow
-                        temp_path = f"/tmp/{name}"
-                        with open(temp_path, "wb") as f:
-                            for chunk in r.iter_content(chunk_size=1024 * 1024):
-                                f.write(chunk)
-                        blob = open(temp_path, "rb").read()
-                    else:
-                        upload_errors.append(f"Failed to download {name}: HTTP {r.status_code}")
-                        continue
-
-            # --- Case 2: Base64-based upload ---
-            elif "image" in image:
-                blob = base64.b64decode(image["image"])
-
-            else:
-                upload_errors.append(f"No valid 'url' or 'image' found for {name}")
-                continue
-
-            files = {
-                "image": (name, BytesIO(blob), "application/octet-stream"),
-                "overwrite": (None, "true"),
-            }
-
-            response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-            if response.status_code != 200:
-                upload_errors.append(f"Error uploading {name}: {response.text}")
-            else:
-                responses.append(f"✅ Uploaded {name}")
-
-        except Exception as e:
-            upload_errors.append(f"Error processing {name}: {str(e)}")
+    async def upload_one(item):
+        async with limit:
+            return await _process_one(item)
+
+    for ok, message in await asyncio.gather(*(upload_one(item) for item in prepared)):
+        if ok:
+            responses.append(message)
+        else:
+            upload_errors.append(message)
 
     if upload_errors:
         print("runpod-worker-comfy - upload completed with errors")
@@ -134,121 +363,286 @@ def upload_images(images):
     return {"status": "success", "message": "All inputs uploaded successfully", "details": responses}
 
 
+async def upload_images(images):
+    """Upload files (Base64 or via URL) to ComfyUI /upload/image endpoint."""
+    return await _post_prepared(_prefetch_blobs(images))
+
+
 # ==========================================
 # COMFYUI WORKFLOW QUEUE
 # ==========================================
-def queue_workflow(workflow):
+async def queue_workflow(workflow):
     """Queue a workflow for ComfyUI processing."""
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    async with get_session().post(
+        f"http://{COMFY_HOST}/prompt",
+        data=orjson.dumps({"prompt": workflow, "client_id": CLIENT_ID}),
+        headers={"Content-Type": "application/json"},
+    ) as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
 
 
-def get_history(prompt_id):
+async def get_history(prompt_id):
     """Retrieve history of a given ComfyUI prompt."""
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    async with get_session().get(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
+        response.raise_for_status()
+        return orjson.loads(await response.read())
+
+
+# ==========================================
+# WAIT FOR COMPLETION (WebSocket or polling)
+# ==========================================
+async def open_websocket(client_id):
+    """Open a ComfyUI websocket subscribed to events for the given client id."""
+    # Latent previews can exceed aiohttp's default message size limit
+    return await get_session().ws_connect(
+        f"ws://{COMFY_HOST}/ws?clientId={client_id}", max_msg_size=0
+    )
+
+
+async def get_websocket(reconnect=False):
+    """Return the worker's ComfyUI websocket, (re)opening it when needed."""
+    global _websocket
+    _ensure_sessions()  # forgets (and may leak) a websocket of a previous event loop
+    if reconnect or _websocket is None or _websocket.closed:
+        if _websocket is not None:
+            await _websocket.close()
+        _websocket = None
+        _websocket = await open_websocket(CLIENT_ID)
+    return _websocket
+
+
+_WS_CLOSED_TYPES = (
+    aiohttp.WSMsgType.CLOSE,
+    aiohttp.WSMsgType.CLOSING,
+    aiohttp.WSMsgType.CLOSED,
+    aiohttp.WSMsgType.ERROR,
+)
+
+
+async def _wait_for_prompt(ws, prompt_id):
+    while True:
+        msg = await ws.receive()
+
+        if msg.type in _WS_CLOSED_TYPES:
+            # Messages sent while disconnected are lost, so check history once
+            print("runpod-worker-comfy - websocket dropped, reconnecting...")
+            ws = await get_websocket(reconnect=True)
+            history = await get_history(prompt_id)
+            if prompt_id in history and history[prompt_id].get("outputs"):
+                return None
+            continue
+
+        # Binary frames are latent previews, nothing to do with completion
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            continue
+
+        message = orjson.loads(msg.data)
+        data = message.get("data", {})
+        if data.get("prompt_id") != prompt_id:
+            continue
+
+        if message.get("type") == "executing" and data.get("node") is None:
+            return None
+        if message.get("type") == "execution_error":
+            return f"Workflow execution failed: {data.get('exception_message', 'unknown error')}"
+
+
+async def wait_for_prompt(ws, prompt_id):
+    """
+    Wait on the ComfyUI websocket until the given prompt has finished executing.
+    Returns None on completion or an error message.
+    """
+    try:
+        return await asyncio.wait_for(
+            _wait_for_prompt(ws, prompt_id),
+            timeout=COMFY_POLLING_INTERVAL_MS * COMFY_POLLING_MAX_RETRIES / 1000,
+        )
+    except asyncio.TimeoutError:
+        return "Max retries reached waiting for generation"
+
+
+async def poll_history(prompt_id):
+    """
+    Fallback when no websocket is available: poll /history until outputs appear.
+    Backs off exponentially within the same overall budget as the websocket wait.
+    """
+    deadline = time.monotonic() + COMFY_POLLING_INTERVAL_MS * COMFY_POLLING_MAX_RETRIES / 1000
+
+    attempt = 0
+    while time.monotonic() < deadline:
+        history = await get_history(prompt_id)
+        if prompt_id in history and history[prompt_id].get("outputs"):
+            return None
+        await asyncio.sleep(backoff_delay(attempt, COMFY_POLLING_BACKOFF_START_MS, COMFY_POLLING_BACKOFF_MAX_MS))
+        attempt += 1
+
+    return "Max retries reached waiting for generation"
+
 
 ##
 # ==========================================
 # UTILS
 # ==========================================
-def base64_encode(file_path):
-    """Convert file (image/video) to base64 string."""
+def base64_encode(file_path, chunk_size=BASE64_ENCODE_CHUNK_BYTES):
+    """Convert file (image/video) to base64 string, reading it in chunks."""
+    # The output is sized up front and never reallocated; the raw file is never
+    # held in memory as a whole.
+    remaining = os.path.getsize(file_path)
+    encoded = bytearray(4 * ((remaining + 2) // 3))
+    view = memoryview(encoded)
+    offset = 0
     with open(file_path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        # A buffered reader returns full chunks until EOF, so padding only ends up at the end
+        while remaining > 0 and (chunk := f.read(min(chunk_size, remaining))):
+            piece = binascii.b2a_base64(chunk, newline=False)
+            view[offset:offset + len(piece)] = piece
+            offset += len(piece)
+            remaining -= len(chunk)
+    return str(view[:offset], "ascii")
 
 
 # ==========================================
 # PROCESS OUTPUT FILES (MULTI-OUTPUT SUPPORT)
 # ==========================================
-def process_output_files(outputs, job_id):
+_OUTPUT_KEYS = ("images", "gifs", "videos", "output")
+_VIDEO_KEYS = frozenset(("videos", "output"))
+_EMPTY = ()
+
+
+def _upload_to_s3(job_id, local_path):
+    """Upload a file with rp_upload, returning its URL. Runs in a worker thread."""
+    # Imported lazily and off the event loop: rp_upload pulls in boto3, which is
+    # slow to import and not needed at all in base64-only mode
+    from runpod.serverless.utils import rp_upload
+
+    return rp_upload.upload_image(job_id, local_path)
+
+
+async def process_output_files(outputs, job_id):
     """
     Collects all generated image/video files and returns URLs or base64 strings.
     Supports multiple outputs (images, gifs, videos, etc.)
     """
+    results = []
+    uploads = []
 
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
-    bucket_url = os.environ.get("BUCKET_ENDPOINT_URL")
+    # Primary video (audio version preferred): 2 = video with audio, 1 = video
+    primary_video = None
+    primary_rank = 0
+
+    # rp_upload is synchronous, run the S3 uploads concurrently in threads
+    limit = asyncio.Semaphore(S3_UPLOAD_MAX_WORKERS)
+
+    async def upload_one(result, local_path):
+        async with limit:
+            result["url"] = await asyncio.to_thread(_upload_to_s3, job_id, local_path)
+        print(f"✅ Uploaded {result['filename']} to S3")
+
+    if DEBUG_OUTPUTS:
+        for node_id, node_output in outputs.items():
+            print(f"🔍 Node {node_id} output keys: {list(node_output.keys())}")
+
+    for node_output in outputs.values():
+        for key in _OUTPUT_KEYS:
+            file_type = "video" if key in _VIDEO_KEYS else "image"
+
+            for file_obj in node_output.get(key, _EMPTY):
+                if "filename" not in file_obj:
+                    continue
+                subfolder = file_obj.get("subfolder")
+                if subfolder:
+                    local_path = os.path.join(COMFY_OUTPUT_PATH, subfolder, file_obj["filename"])
+                else:
+                    local_path = COMFY_OUTPUT_BASE + file_obj["filename"]
+                filename = os.path.basename(local_path)
+                result = {"type": file_type, "filename": filename}
+
+                if not os.path.exists(local_path):
+                    print(f"❌ Missing file: {local_path}")
+                    result["status"] = "missing"
+                    result["message"] = f"File not found: {local_path}"
+                elif BUCKET_URL:
+                    # Upload to S3 concurrently, the URL is filled in below
+                    result["status"] = "uploaded"
+                    uploads.append(asyncio.create_task(upload_one(result, local_path)))
+                else:
+                    result["status"] = "base64"
+                    result["data"] = await asyncio.to_thread(base64_encode, local_path)
+                    print(f"✅ Encoded {filename} to base64")
+                results.append(result)
+
+                if file_type == "video":
+                    rank = 2 if "-audio" in filename else 1
+                    if rank > primary_rank:
+                        primary_video, primary_rank = result, rank
+
+    await asyncio.gather(*uploads)
+
+    if not results:
+        print("⚠️ No image/video outputs found")
+        return {"status": "error", "message": "No image or video outputs found."}
 
-    output_files = []
+    return {"status": "success", "files": results, "primary_video": primary_video}
 
-    for node_id, node_output in outputs.items():
-        print(f"🔍 Node {node_id} output keys: {list(node_output.keys())}")
 
-        for key in ["images", "gifs", "videos", "output"]:
-            if key in node_output:
-                for file_obj in node_output[key]:
-                    if "filename" not in file_obj:
-                        continue
-                    file_path = os.path.join(
-                        COMFY_OUTPUT_PATH, file_obj.get("subfolder", ""), file_obj["filename"]
-                    )
-                    output_files.append({
-                        "type": "video" if key in ["videos", "output"] else "image",
-                        "path": file_path
-                    })
+# ==========================================
+# RESULT CACHE
+# ==========================================
+# Results of finished jobs, keyed by workflow + inputs. Replayed jobs with the
+# same prompt are answered without running ComfyUI again. Opt-in via
+# RESULT_CACHE_TTL_S, as it assumes the workflow is deterministic and only
+# depends on the inputs sent with the job. Only S3 results are kept, so the
+# cache holds URLs and never base64 payloads.
+_RESULT_CACHE = OrderedDict()
+
+
+def result_cache_key(workflow, images):
+    """Cache key for a job, or None if its result must not be cached."""
+    if REFRESH_WORKER or RESULT_CACHE_TTL_S <= 0:
+        return None
+
+    inputs = []
+    for image in images or ():
+        # The content behind a URL may change between jobs
+        if "url" in image or not isinstance(image.get("image"), str):
+            return None
+        inputs.append((image["name"], hashlib.sha256(image["image"].encode("utf-8")).hexdigest()))
 
-    if not output_files:
-        print("⚠️ No image/video outputs found")
-        return {"status": "error", "message": "No image or video outputs found."}
+    try:
+        payload = orjson.dumps({"workflow": workflow, "images": inputs}, option=orjson.OPT_SORT_KEYS)
+    except orjson.JSONEncodeError:
+        return None
+    return hashlib.sha256(payload).hexdigest()
 
-    results = []
 
-    for item in output_files:
-        local_path = item["path"]
-        file_type = item["type"]
-        filename = os.path.basename(local_path)
-
-        if not os.path.exists(local_path):
-            print(f"❌ Missing file: {local_path}")
-            results.append({
-                "type": file_type,
-                "filename": filename,
-                "status": "missing",
-                "message": f"File not found: {local_path}"
-            })
-            continue
+def get_cached_result(key):
+    """Return the cached result for `key` if present and not expired."""
+    entry = _RESULT_CACHE.get(key)
+    if entry is None:
+        return None
 
-        # Upload to S3 or encode as base64
-        if bucket_url:
-            uploaded_url = rp_upload.upload_image(job_id, local_path)
-            print(f"✅ Uploaded {filename} to S3")
-            results.append({
-                "type": file_type,
-                "filename": filename,
-                "status": "uploaded",
-                "url": uploaded_url
-            })
-        else:
-            encoded = base64_encode(local_path)
-            print(f"✅ Encoded {filename} to base64")
-            results.append({
-                "type": file_type,
-                "filename": filename,
-                "status": "base64",
-                "data": encoded
-            })
-
-    # Identify primary video (audio version preferred)
-    primary_video = None
-    for f in results:
-        if f["type"] == "video" and "-audio" in f["filename"]:
-            primary_video = f
-            break
-    if not primary_video:
-        for f in results:
-            if f["type"] == "video":
-                primary_video = f
-                break
+    expires_at, result = entry
+    if expires_at < time.monotonic():
+        del _RESULT_CACHE[key]
+        return None
 
-    return {"status": "success", "files": results, "primary_video": primary_video}
+    _RESULT_CACHE.move_to_end(key)
+    return result
+
+
+def put_cached_result(key, result):
+    """Store a result, evicting the least recently used entries beyond the cache size."""
+    _RESULT_CACHE[key] = (time.monotonic() + RESULT_CACHE_TTL_S, result)
+    _RESULT_CACHE.move_to_end(key)
+    while len(_RESULT_CACHE) > RESULT_CACHE_MAX_ITEMS:
+        _RESULT_CACHE.popitem(last=False)
 
 
 # ==========================================
 # MAIN HANDLER
 # ==========================================
-def handler(job):
+async def handler(job):
     """Main RunPod handler that processes a ComfyUI workflow job."""
     job_input = job["input"]
 
@@ -259,42 +653,68 @@ def handler(job):
     workflow = validated_data["workflow"]
     images = validated_data.get("images")
 
-    # Wait for ComfyUI server availability
-    check_server(f"http://{COMFY_HOST}",
-                 COMFY_API_AVAILABLE_MAX_RETRIES,
-                 COMFY_API_AVAILABLE_INTERVAL_MS)
+    # Identical jobs replayed on a warm worker are answered from the cache
+    cache_key = result_cache_key(workflow, images)
+    if cache_key is not None:
+        cached = get_cached_result(cache_key)
+        if cached is not None:
+            print("runpod-worker-comfy - returning cached result")
+            return {**cached, "refresh_worker": REFRESH_WORKER}
+
+    # Wait for ComfyUI server availability while decoding the inputs
+    _, prepared = await asyncio.gather(
+        check_server(f"http://{COMFY_HOST}",
+                     COMFY_API_AVAILABLE_MAX_RETRIES,
+                     COMFY_API_AVAILABLE_INTERVAL_MS),
+        asyncio.to_thread(_prefetch_blobs, images),
+    )
 
     # Upload input images/videos (Base64 or via URL)
-    upload_result = upload_images(images)
+    upload_result = await _post_prepared(prepared)
     if upload_result["status"] == "error":
         return upload_result
 
+    # Subscribe to execution events before queuing so no message is missed.
+    # The websocket is kept open across jobs.
+    try:
+        ws = await get_websocket()
+    except Exception as e:
+        print(f"runpod-worker-comfy - websocket unavailable, falling back to polling: {str(e)}")
+        ws = None
+
     # Queue workflow
     try:
-        queued = queue_workflow(workflow)
+        queued = await queue_workflow(workflow)
         prompt_id = queued["prompt_id"]
         print(f"runpod-worker-comfy - queued workflow ID: {prompt_id}")
     except Exception as e:
         return {"error": f"Error queuing workflow: {str(e)}"}
 
-    # Poll until workflow completes
+    # Wait until workflow completes
     print("runpod-worker-comfy - waiting for generation to complete...")
-    retries = 0
     try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
-            if prompt_id in history and history[prompt_id].get("outputs"):
-                break
-            time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-            retries += 1
+        if ws is not None:
+            wait_error = await wait_for_prompt(ws, prompt_id)
         else:
-            return {"error": "Max retries reached waiting for generation"}
+            wait_error = await poll_history(prompt_id)
+        if wait_error:
+            return {"error": wait_error}
+
+        history = await get_history(prompt_id)
     except Exception as e:
         return {"error": f"Error while waiting for generation: {str(e)}"}
 
+    if prompt_id not in history:
+        return {"error": f"No history found for prompt {prompt_id}"}
+
     # Process outputs (supports multiple formats)
     outputs = history[prompt_id].get("outputs", {})
-    result_files = process_output_files(outputs, job["id"])
+    result_files = await process_output_files(outputs, job["id"])
+
+    if cache_key is not None and result_files["status"] == "success" and all(
+        f["status"] == "uploaded" for f in result_files["files"]
+    ):
+        put_cached_result(cache_key, result_files)
 
     # Include refresh flag for RunPod
     return {**result_files, "refresh_worker": REFRESH_WORKER}
@@ -1,9 +1,10 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, mock_open, Mock, AsyncMock
 import sys
 import os
 import json
 import base64
+import asyncio
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
@@ -13,6 +14,19 @@ from src import rp_handler
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
 
 
+def mock_aiohttp_response(status=200, body=b""):
+    """Mock the async context manager returned by aiohttp's session.get / session.post."""
+    response = MagicMock()
+    response.status = status
+    response.read = AsyncMock(return_value=body)
+    response.text = AsyncMock(return_value=body.decode("utf-8"))
+
+    context = MagicMock()
+    context.__aenter__ = AsyncMock(return_value=response)
+    context.__aexit__ = AsyncMock(return_value=False)
+    return context
+
+
 class TestRunpodWorkerComfy(unittest.TestCase):
     def test_valid_input_with_workflow_only(self):
         input_data = {"workflow": {"key": "value"}}
@@ -58,97 +72,182 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNone(error)
         self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
 
+    def test_repeated_json_string_input_is_parsed_per_call(self):
+        input_data = '{"workflow": {"key": "value"}}'
+        first, _ = rp_handler.validate_input(input_data)
+        validated_data, error = rp_handler.validate_input(input_data)
+
+        self.assertIsNone(error)
+        self.assertEqual(validated_data, first)
+        self.assertIsNot(validated_data["workflow"], first["workflow"])
+
     def test_empty_input(self):
         input_data = None
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_up(self, mock_requests):
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_requests.return_value = mock_response
-
-        result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
+    def test_sessions_are_recreated_for_a_new_event_loop(self):
+        async def first_loop():
+            session = rp_handler.get_session()
+            download_session = rp_handler.get_download_session()
+            await session.close()
+            await download_session.close()
+            return session
+
+        async def second_loop(previous):
+            session = rp_handler.get_session()
+            download_session = rp_handler.get_download_session()
+            try:
+                self.assertIsNot(session, previous)
+                self.assertIsNot(session, download_session)
+            finally:
+                await session.close()
+                await download_session.close()
+
+        asyncio.run(second_loop(asyncio.run(first_loop())))
+
+    @patch("src.rp_handler.get_session")
+    def test_check_server_server_up(self, mock_get_session):
+        mock_get_session.return_value.get.return_value = mock_aiohttp_response(200)
+
+        result = asyncio.run(rp_handler.check_server("http://127.0.0.1:8188", 1, 50))
         self.assertTrue(result)
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
-        result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
+    @patch("src.rp_handler.get_session")
+    def test_check_server_server_down(self, mock_get_session):
+        mock_get_session.return_value.get.side_effect = rp_handler.aiohttp.ClientError()
+        result = asyncio.run(rp_handler.check_server("http://127.0.0.1:8188", 1, 50))
+        self.assertFalse(result)
+
+    @patch("src.rp_handler.get_session")
+    def test_check_server_gives_up_after_timeout(self, mock_get_session):
+        mock_get_session.return_value.get.side_effect = rp_handler.aiohttp.ClientError()
+
+        result = asyncio.run(
+            rp_handler.check_server("http://127.0.0.1:8188", 500, 10, 1000, timeout=100)
+        )
+
         self.assertFalse(result)
+        self.assertLess(mock_get_session.return_value.get.call_count, 500)
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_queue_prompt(self, mock_urlopen):
-        mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
-        result = rp_handler.queue_workflow({"prompt": "test"})
+    @patch("src.rp_handler.get_session")
+    def test_queue_prompt(self, mock_get_session):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = mock_aiohttp_response(
+            200, json.dumps({"prompt_id": "123"}).encode()
+        )
+        result = asyncio.run(rp_handler.queue_workflow({"prompt": "test"}))
         self.assertEqual(result, {"prompt_id": "123"})
+        mock_post.assert_called_with(
+            "http://127.0.0.1:8188/prompt",
+            data=json.dumps(
+                {"prompt": {"prompt": "test"}, "client_id": rp_handler.CLIENT_ID},
+                separators=(",", ":"),
+            ).encode(),
+            headers={"Content-Type": "application/json"},
+        )
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_get_history(self, mock_urlopen):
-        # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode("utf-8")
+    @patch("src.rp_handler.get_session")
+    def test_get_history(self, mock_get_session):
+        mock_get = mock_get_session.return_value.get
+        mock_get.return_value = mock_aiohttp_response(
+            200, json.dumps({"key": "value"}).encode("utf-8")
+        )
 
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
+        result = asyncio.run(rp_handler.get_history("123"))
 
-        # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
+        self.assertEqual(result, {"key": "value"})
+        mock_get.assert_called_with("http://127.0.0.1:8188/history/123")
 
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
+    def test_wait_for_prompt_completes_on_executing_none(self):
+        text, binary = rp_handler.aiohttp.WSMsgType.TEXT, rp_handler.aiohttp.WSMsgType.BINARY
+        mock_ws = MagicMock()
+        mock_ws.receive = AsyncMock(side_effect=[
+            Mock(type=binary, data=b"binary preview frame"),
+            Mock(type=text, data=json.dumps({"type": "executing", "data": {"node": None, "prompt_id": "other"}})),
+            Mock(type=text, data=json.dumps({"type": "executing", "data": {"node": "3", "prompt_id": "123"}})),
+            Mock(type=text, data=json.dumps({"type": "executing", "data": {"node": None, "prompt_id": "123"}})),
+        ])
 
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+        result = asyncio.run(rp_handler.wait_for_prompt(mock_ws, "123"))
 
-        # Call the function under test
-        result = rp_handler.get_history("123")
+        self.assertIsNone(result)
+        self.assertEqual(mock_ws.receive.call_count, 4)
 
-        # Assertions
-        self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+    def test_multipart_envelope(self):
+        head, tail = rp_handler._multipart_envelope("image.png", "xyz")
+        body = head + b"abcd" + tail
+
+        self.assertTrue(body.startswith(b"--xyz\r\n"))
+        self.assertIn(b'name="image"; filename="image.png"\r\n', body)
+        self.assertIn(b"\r\n\r\nabcd\r\n--xyz--\r\n", body)
+
+    def test_prefetch_invalid_base64_value_returns_error_item(self):
+        prepared = rp_handler._prefetch_blobs([{"name": "x", "image": None}])
+
+        self.assertEqual(len(prepared), 1)
+        self.assertTrue(prepared[0]["error"].startswith("Error processing x:"))
+
+    @patch("src.rp_handler.BASE64_DECODE_CHUNK_CHARS", 8)
+    def test_b64decode_into(self):
+        data = base64.b64encode(b"Test Image Data").decode("utf-8")
+        buf = rp_handler.get_buf(len(data) * 3 // 4)
+
+        decoded_len = rp_handler.b64decode_into(data, buf)
+
+        self.assertEqual(bytes(buf[:decoded_len]), b"Test Image Data")
 
+    @patch("src.rp_handler.BASE64_DECODE_CHUNK_CHARS", 64)
+    def test_prefetch_tab_wrapped_base64_spanning_chunks(self):
+        raw = os.urandom(5000)
+        encoded = base64.b64encode(raw).decode("utf-8")
+        wrapped = "\t".join(encoded[i:i + 57] for i in range(0, len(encoded), 57))
+
+        prepared = rp_handler._prefetch_blobs([{"name": "x", "image": wrapped}])[0]
+        try:
+            self.assertNotIn("error", prepared)
+            self.assertEqual(bytes(prepared["buf"][:prepared["length"]]), raw)
+        finally:
+            rp_handler.put_buf(prepared["buf"])
+
+    @patch("src.rp_handler.os.path.getsize", return_value=4)
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
-    def test_base64_encode(self, mock_file):
+    def test_base64_encode(self, mock_file, mock_getsize):
         test_data = base64.b64encode(b"test").decode("utf-8")
 
         result = rp_handler.base64_encode("dummy_path")
 
         self.assertEqual(result, test_data)
 
-    @patch("rp_handler.os.path.exists")
-    @patch("rp_handler.rp_upload.upload_image")
-    @patch.dict(
-        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
-    )
-    def test_bucket_endpoint_not_configured(self, mock_upload_image, mock_exists):
+    @patch("src.rp_handler.os.path.exists")
+    @patch("src.rp_handler.base64_encode")
+    @patch("src.rp_handler.BUCKET_URL", None)
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    @patch("src.rp_handler.COMFY_OUTPUT_BASE", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES + "/")
+    def test_bucket_endpoint_not_configured(self, mock_base64_encode, mock_exists):
         mock_exists.return_value = True
-        mock_upload_image.return_value = "simulated_uploaded/image.png"
+        mock_base64_encode.return_value = "base64string"
 
         outputs = {
             "node_id": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": ""}]}
         }
         job_id = "123"
 
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = asyncio.run(rp_handler.process_output_files(outputs, job_id))
 
         self.assertEqual(result["status"], "success")
+        self.assertEqual(result["files"][0]["status"], "base64")
+        self.assertEqual(result["files"][0]["data"], "base64string")
+        mock_base64_encode.assert_called_once_with(
+            "./test_resources/images/ComfyUI_00001_.png"
+        )
 
-    @patch("rp_handler.os.path.exists")
-    @patch("rp_handler.rp_upload.upload_image")
-    @patch.dict(
-        os.environ,
-        {
-            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
-            "BUCKET_ENDPOINT_URL": "http://example.com",
-        },
-    )
+    @patch("src.rp_handler.os.path.exists")
+    @patch("runpod.serverless.utils.rp_upload.upload_image")
+    @patch("src.rp_handler.BUCKET_URL", "http://example.com")
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    @patch("src.rp_handler.COMFY_OUTPUT_BASE", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES + "/")
     def test_bucket_endpoint_configured(self, mock_upload_image, mock_exists):
         # Mock the os.path.exists to return True, simulating that the image exists
         mock_exists.return_value = True
@@ -161,22 +260,23 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         job_id = "123"
 
         # Call the function under test
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = asyncio.run(rp_handler.process_output_files(outputs, job_id))
 
         # Assertions
         self.assertEqual(result["status"], "success")
-        self.assertEqual(result["message"], "http://example.com/uploaded/image.png")
+        self.assertEqual(result["files"][0]["url"], "http://example.com/uploaded/image.png")
         mock_upload_image.assert_called_once_with(
             job_id, "./test_resources/images/test/ComfyUI_00001_.png"
         )
 
-    @patch("rp_handler.os.path.exists")
-    @patch("rp_handler.rp_upload.upload_image")
+    @patch("src.rp_handler.os.path.exists")
+    @patch("runpod.serverless.utils.rp_upload.upload_image")
+    @patch("src.rp_handler.BUCKET_URL", "http://example.com")
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    @patch("src.rp_handler.COMFY_OUTPUT_BASE", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES + "/")
     @patch.dict(
         os.environ,
         {
-            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
-            "BUCKET_ENDPOINT_URL": "http://example.com",
             "BUCKET_ACCESS_KEY_ID": "",
             "BUCKET_SECRET_ACCESS_KEY": "",
         },
@@ -195,40 +295,121 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         job_id = "123"
 
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = asyncio.run(rp_handler.process_output_files(outputs, job_id))
 
         # Check if the image was saved to the 'simulated_uploaded' directory
-        self.assertIn("simulated_uploaded", result["message"])
+        self.assertIn("simulated_uploaded", result["files"][0]["url"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
-    def test_upload_images_successful(self, mock_post):
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 200
-        mock_response.text = "Successfully uploaded"
-        mock_post.return_value = mock_response
+    @patch("src.rp_handler.os.path.exists")
+    @patch("src.rp_handler.BUCKET_URL", None)
+    @patch("src.rp_handler.COMFY_OUTPUT_PATH", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES)
+    @patch("src.rp_handler.COMFY_OUTPUT_BASE", RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES + "/")
+    def test_primary_video_prefers_audio_version(self, mock_exists):
+        mock_exists.return_value = False
+
+        outputs = {
+            "1": {"images": [{"filename": "frame.png"}]},
+            "2": {"videos": [{"filename": "clip.mp4"}, {"filename": "clip-audio.mp4"}]},
+        }
+
+        result = asyncio.run(rp_handler.process_output_files(outputs, "123"))
+
+        self.assertEqual(len(result["files"]), 3)
+        self.assertEqual(result["primary_video"]["filename"], "clip-audio.mp4")
+
+    @patch.dict(rp_handler._RESULT_CACHE, clear=True)
+    @patch("src.rp_handler.RESULT_CACHE_TTL_S", 3600)
+    @patch("src.rp_handler.REFRESH_WORKER", False)
+    def test_result_cache(self):
+        workflow = {"3": {"inputs": {"seed": 1}, "class_type": "KSampler"}}
+        images = [{"name": "image1.png", "image": "base64string"}]
+        key = rp_handler.result_cache_key(workflow, images)
+
+        self.assertEqual(key, rp_handler.result_cache_key(dict(workflow), list(images)))
+        self.assertIsNone(
+            rp_handler.result_cache_key(workflow, [{"name": "image1.png", "url": "http://x"}])
+        )
+        self.assertIsNone(rp_handler.result_cache_key(workflow, [{"name": "x", "image": None}]))
+        self.assertIsNone(rp_handler.result_cache_key(workflow, [{"name": "x", "image": 123}]))
+
+        self.assertIsNone(rp_handler.get_cached_result(key))
+        rp_handler.put_cached_result(key, {"status": "success", "files": []})
+        self.assertEqual(rp_handler.get_cached_result(key), {"status": "success", "files": []})
+
+    def test_result_cache_disabled_by_default(self):
+        self.assertEqual(rp_handler.RESULT_CACHE_TTL_S, 0)
+        self.assertIsNone(rp_handler.result_cache_key({"key": "value"}, None))
+
+    @patch.dict(rp_handler._RESULT_CACHE, clear=True)
+    @patch("src.rp_handler.RESULT_CACHE_TTL_S", 3600)
+    @patch("src.rp_handler.REFRESH_WORKER", False)
+    @patch("src.rp_handler.queue_workflow", new_callable=AsyncMock)
+    def test_handler_cache_hit_skips_queue_workflow(self, mock_queue_workflow):
+        workflow = {"key": "value"}
+        images = [{"name": "image1.png", "image": "base64string"}]
+        cached = {"status": "success", "files": [{"status": "uploaded", "url": "http://x"}]}
+        rp_handler.put_cached_result(rp_handler.result_cache_key(workflow, images), cached)
+
+        result = asyncio.run(
+            rp_handler.handler({"id": "123", "input": {"workflow": workflow, "images": images}})
+        )
+
+        self.assertEqual(result, {**cached, "refresh_worker": False})
+        mock_queue_workflow.assert_not_called()
+
+    @patch.dict(rp_handler._RESULT_CACHE, clear=True)
+    @patch("src.rp_handler.RESULT_CACHE_TTL_S", 3600)
+    @patch("src.rp_handler.REFRESH_WORKER", False)
+    @patch("src.rp_handler.check_server", new_callable=AsyncMock)
+    @patch("src.rp_handler._post_prepared", new_callable=AsyncMock)
+    @patch("src.rp_handler.get_websocket", new_callable=AsyncMock)
+    @patch("src.rp_handler.queue_workflow", new_callable=AsyncMock)
+    def test_handler_cache_miss_for_url_inputs(
+        self, mock_queue_workflow, mock_get_websocket, mock_post_prepared, mock_check_server
+    ):
+        workflow = {"key": "value"}
+        rp_handler.put_cached_result(rp_handler.result_cache_key(workflow, None), {"status": "success"})
+        mock_post_prepared.return_value = {"status": "success"}
+        mock_get_websocket.side_effect = Exception("no websocket")
+        mock_queue_workflow.side_effect = Exception("ComfyUI down")
+
+        result = asyncio.run(
+            rp_handler.handler({
+                "id": "123",
+                "input": {"workflow": workflow, "images": [{"name": "a.png", "url": "http://x/a.png"}]},
+            })
+        )
+
+        self.assertEqual(result, {"error": "Error queuing workflow: ComfyUI down"})
+        mock_queue_workflow.assert_called_once_with(workflow)
+
+    @patch("src.rp_handler.get_session")
+    def test_upload_images_successful(self, mock_get_session):
+        mock_get_session.return_value.post.return_value = mock_aiohttp_response(
+            200, b"Successfully uploaded"
+        )
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
 
         images = [{"name": "test_image.png", "image": test_image_data}]
 
-        responses = rp_handler.upload_images(images)
+        responses = asyncio.run(rp_handler.upload_images(images))
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
-    def test_upload_images_failed(self, mock_post):
-        mock_response = unittest.mock.Mock()
-        mock_response.status_code = 400
-        mock_response.text = "Error uploading"
-        mock_post.return_value = mock_response
+    @patch("src.rp_handler.get_session")
+    def test_upload_images_failed(self, mock_get_session):
+        mock_get_session.return_value.post.return_value = mock_aiohttp_response(
+            400, b"Error uploading"
+        )
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
 
         images = [{"name": "test_image.png", "image": test_image_data}]
 
-        responses = rp_handler.upload_images(images)
+        responses = asyncio.run(rp_handler.upload_images(images))
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")